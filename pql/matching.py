@@ -74,15 +74,39 @@ def parse_date(node):
                          col_offset=node.col_offset)
 
 
+def join_attribute(attr, handle_base):
+    """
+    Gets the dotted name of an attribute chain, walking down the chain instead of recursing per level
+    :param attr: the outermost Attribute node (a.b.c)
+    :param handle_base: handles the node the chain starts from (a Name or a Str)
+    :return: the dotted name
+    """
+    parts = []
+    while isinstance(attr, ast.Attribute):
+        parts.append(attr.attr)
+        attr = attr.value
+    parts.append(handle_base(attr))
+    return '.'.join(reversed(parts))
+
+
 class BaseAstHandler(object):
+    # maps a handled name (AST node class or function name) to its handle_* function.
+    # built once per class since handlers are never added at runtime.
+    _DISPATCH = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._DISPATCH = {name[len('handle_'):]: getattr(cls, name)
+                         for name in dir(cls) if name.startswith('handle_')}
+
     def get_options(self):
         return [f.replace('handle_', '') for f in dir(self) if f.startswith('handle_')]
 
     def resolve(self, thing):
         thing_name = thing.__class__.__name__
         try:
-            handler = getattr(self, 'handle_' + thing_name)
-        except AttributeError:
+            handler = self._DISPATCH[thing_name].__get__(self)
+        except KeyError:
             raise ParseError(f'Unsupported syntax ({0}) on {self.__class__}.'.format(thing_name,
                                                                                      self.get_options()),
                              col_offset=thing.col_offset if hasattr(
@@ -94,7 +118,11 @@ class BaseAstHandler(object):
 class AstHandler(BaseAstHandler):
 
     def handle(self, thing):
-        return self.resolve(thing)(thing)
+        try:
+            handler = self._DISPATCH[thing.__class__.__name__]
+        except KeyError:
+            return self.resolve(thing)(thing)
+        return handler(self, thing)
 
     def parse(self, string):
         ex = ast.parse(string, mode='eval')
@@ -242,7 +270,7 @@ class FieldName(AstHandler):
         return name.id
 
     def handle_Attribute(self, attr):
-        return '{0}.{1}'.format(self.handle(attr.value), attr.attr)
+        return join_attribute(attr, self.handle)
 
 
 class OperatorMap(object):
@@ -303,12 +331,12 @@ class Func(BaseFunc, AstHandler):
 
     def handle(self, node):
         try:
-            handler = getattr(self, 'handle_' + node.func.id)
-        except AttributeError:
+            handler = self._DISPATCH[node.func.id]
+        except KeyError:
             raise ParseError('Unsupported function ({0}).'.format(node.func.id),
                              col_offset=node.col_offset,
                              options=self.get_options())
-        return handler(node)
+        return handler(self, node)
 
     def handle_exists(self, node):
         return {'$exists': self.parse_arg(node, 0, BoolField())}
@@ -1,74 +1,157 @@
 """
 This file includes Projection specific AST parsers.
-Most of them are identical to regular parsers but with **kwargs in the signature.
-The kwargs have 3 arguments which are used across the parser logic -
+Most of them are identical to regular parsers but with a ctx argument in the signature.
+The ctx is a Ctx tuple with 3 main members which are used across the parser logic -
 compared_field, array_fields and complex_fields.
 compared_fields is the fields from the left hand of the expression.
 array fields is a set of all fields of array type.
 complex fields is a set of all complex fields that are being filtered.
+The same ctx is passed down unchanged, only the compared field is replaced when a comparison is parsed.
+It also holds value_ref - the reference the literals are compared against, resolved together with the compared field.
 
-Some of the methods, receive **kwargs but doesn't use it - it's important not to remove.
+Some of the methods, receive ctx but doesn't use it - it's important not to remove.
 There are some generic methods which calls these method according to the AST type.
 """
 import ast
+import sys
+from functools import lru_cache
+from typing import Collection, NamedTuple, Optional
 
 from axonius.pql.matching import BaseAstHandler, BaseParser, ParseError,\
     GenericField, BaseFunc, IntFunc, ListFunc, DateTimeFunc, BaseOperator,\
     StringBaseField, IntBaseField, BoolBaseField, DictBaseField, ListBaseField,\
-    BaseField
+    BaseField, join_attribute
+
+
+class Ctx(NamedTuple):
+    compared_field: Optional[str] = None
+    array_fields: Optional[Collection[str]] = None
+    complex_fields: Optional[Collection[str]] = None
+    # reference to the compared value, resolved once per comparison instead of once per literal
+    value_ref: Optional[str] = None
+
+    def compare(self, field: str) -> 'Ctx':
+        """
+        Gets a ctx for comparing the given field.
+        Inside the array wrapper the value is the element variable - '$$<last part of the field>', otherwise '$<field>'
+        """
+        if self.array_fields is not None and field in self.array_fields:
+            value_ref = f'$${field.rpartition(".")[2]}'
+        else:
+            value_ref = f'${field}'
+        return self._replace(compared_field=field, value_ref=value_ref)
+
+
+_EMPTY_CTX = Ctx()
+# keys of the generated documents - python only interns identifier-like constants, so the '$' ones aren't by default
+_AND = sys.intern('$and')
+_OR = sys.intern('$or')
+_EQ = sys.intern('$eq')
+_NE = sys.intern('$ne')
+_TYPE = sys.intern('$type')
+_TEXT = sys.intern('$text')
+_SEARCH = sys.intern('$search')
+_CASE_SENSITIVE = sys.intern('$caseSensitive')
+_REGEX_MATCH = sys.intern('$regexMatch')
+_IS_ARRAY = sys.intern('$isArray')
+_ANY_ELEMENT_TRUE = sys.intern('$anyElementTrue')
+_MAP = sys.intern('$map')
+_COND = sys.intern('$cond')
+_IF = sys.intern('if')
+_THEN = sys.intern('then')
+_ELSE = sys.intern('else')
+_INPUT = sys.intern('input')
+_AS = sys.intern('as')
+_IN = sys.intern('in')
+_REGEX = sys.intern('regex')
+_OPTIONS = sys.intern('options')
+_STRING = sys.intern('string')
+_MISSING = sys.intern('missing')
+
+
+def _freeze(fields):
+    return None if fields is None else frozenset(fields)
+
+
+@lru_cache(maxsize=1024)
+def _parse_ast(string):
+    """
+    The same expressions are parsed repeatedly (e.g. with different array/complex fields), so their AST is cached.
+    The handlers only read the tree, it must not be modified.
+    """
+    return ast.parse(string, mode='eval').body
 
 
 class ProjectionAstHandler(BaseAstHandler):
 
-    def handle(self, thing, **kwargs):
-        return self.resolve(thing)(thing, **kwargs)
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # maps an AST node type to its handle_* function, filled on first use of each type
+        cls._TYPE_DISPATCH = {}
+
+    def _handler_for(self, thing):
+        try:
+            return self._TYPE_DISPATCH[type(thing)]
+        except KeyError:
+            handler = self._TYPE_DISPATCH[type(thing)] = self.resolve(thing).__func__
+            return handler
 
-    def parse(self, string, **kwargs):
-        ex = ast.parse(string, mode='eval')
-        return self.handle(ex.body, **kwargs)
+    def handle(self, thing, ctx=None):
+        handler = self._handler_for(thing)
+        # handlers shared with the regular parsers don't take a ctx, so it's only passed when given
+        if ctx is None:
+            return handler(self, thing)
+        return handler(self, thing, ctx)
+
+    def parse(self, string, compared_field=None, array_fields=None, complex_fields=None):
+        # callers may pass any collection, a frozenset makes the membership tests on every compare cheap
+        ctx = Ctx(array_fields=_freeze(array_fields), complex_fields=_freeze(complex_fields))
+        if compared_field is not None:
+            ctx = ctx.compare(compared_field)
+        return self.handle(_parse_ast(string), ctx)
 
 
 class ProjectionParser(BaseParser, ProjectionAstHandler):
     def __init__(self, operator_map):
         self._operator_map = operator_map
 
-    def handle_Call(self, op, **kwargs):
+    def handle_Dict(self, dict_node, ctx=_EMPTY_CTX):
+        '''Empty'''
+        return {}
+
+    def handle_Call(self, op, ctx=_EMPTY_CTX):
         if op.func.id != 'search':
             raise ParseError(f'Unsupported method call {op.func.id}')
-        return {'$text': {'$search': f'\"{op.args[0].s}\"', '$caseSensitive': False}}
-
-    def handle_BoolOp(self, op, **kwargs):
-        def handle_op(value):
-            return self.handle(value, **kwargs)
+        return {_TEXT: {_SEARCH: f'\"{op.args[0].s}\"', _CASE_SENSITIVE: False}}
 
-        return {self.handle(op.op, **kwargs): list(map(handle_op, op.values))}
+    def handle_BoolOp(self, op, ctx=_EMPTY_CTX):
+        # a boolean operator is either `and` or `or`, no need to dispatch on it
+        handle = self.handle
+        return {_AND if isinstance(op.op, ast.And) else _OR: [handle(value, ctx) for value in op.values]}
 
-    def handle_And(self, op, **kwargs):
-        '''and'''
-        return '$and'
-
-    def handle_Or(self, op, **kwargs):
-        '''or'''
-        return '$or'
-
-    def handle_UnaryOp(self, op, **kwargs):
-        operator = self.handle(op.operand, **kwargs)
-        field, value = list(operator.items())[0]
+    def handle_UnaryOp(self, op, ctx=_EMPTY_CTX):
+        # projection expressions are single key documents (unlike find queries, the operator isn't pushed
+        # under a field), so the operand is wrapped as is instead of being taken apart and rebuilt
         return {
-            self.handle(op.op): {
-                field: value
-            }
+            self.handle(op.op): self.handle(op.operand, ctx)
         }
 
-    def handle_Compare(self, compare, **kwargs):
-        if len(compare.comparators) != 1:
-            raise ParseError('Invalid number of comparators: {0}'.format(len(compare.comparators)),
-                             col_offset=compare.comparators[1].col_offset)
+    def handle_Compare(self, compare, ctx=_EMPTY_CTX):
+        comparators = compare.comparators
+        if len(comparators) != 1:
+            raise ParseError('Invalid number of comparators: {0}'.format(len(comparators)),
+                             col_offset=comparators[1].col_offset)
+        left, right = compare.left, comparators[0]
+        # field to field comparisons (optionally with an offset) never parse as a value comparison,
+        # so they skip failing through the operator map
+        if isinstance(left, ast.BinOp):
+            return self.handle_field_comparison(compare)
         try:
-            return self._operator_map.handle(left=compare.left,
-                                             operator=compare.ops[0],
-                                             right=compare.comparators[0],
-                                             **kwargs)
+            if isinstance(right, (ast.BinOp, ast.Attribute)):
+                # the left field is still resolved, so a schema can reject it
+                self._operator_map.resolve_field(left)
+                return self.handle_field_comparison(compare)
+            return self._operator_map.handle(compare.ops[0], left, right, ctx)
         except ParseError as err:
             if err.message.startswith('Unsupported syntax'):
                 return self.handle_field_comparison(compare)
@@ -81,67 +164,83 @@ class ProjectionSchemaFreeParser(ProjectionParser):
 
 
 class FieldName(ProjectionAstHandler):
-    def handle_Str(self, node):
+    def handle_Str(self, node, ctx=_EMPTY_CTX):
         return node.s
 
-    def handle_Name(self, name):
+    def handle_Name(self, name, ctx=_EMPTY_CTX):
         return name.id
 
-    def handle_Attribute(self, attr):
-        return '{0}.{1}'.format(self.handle(attr.value), attr.attr)
+    def handle_Attribute(self, attr, ctx=_EMPTY_CTX):
+        return join_attribute(attr, self.handle)
+
+
+# handlers are stateless, so a single instance of each is shared instead of creating one per AST node
+_FIELD_NAME = FieldName()
 
 
 class OperatorMap(object):
     def resolve_field(self, node):
-        return FieldName().handle(node)
+        return _FIELD_NAME.handle(node)
 
-    def handle(self, operator, left, right):
+    def handle(self, operator, left, right, ctx=None):
+        # regular find maps build {field: value} documents, they don't use the ctx
         field = self.resolve_field(left)
         return {field: self.resolve_type(field).handle_operator_and_right(operator, right)}
 
 
-class ProjectionMap(object):
-    def resolve_field(self, node):
-        return FieldName().handle(node)
-
-    def handle(self, operator, left, right, compared_field=None, array_fields=None, complex_fields=None):
-        field = self.resolve_field(left)
-        condition = self.resolve_type(field).handle_operator_with_right_and_left(operator, right, compared_field=field,
-                                                                                 array_fields=array_fields,
-                                                                                 complex_fields=complex_fields)
-
-        if (complex_fields and field in complex_fields) and (array_fields and field in array_fields):
-            return {
-                '$and': [
-                    {
-                        '$isArray': f'${field}'
-                    },
-                    {
-                        '$anyElementTrue': {
-                            '$map': {
-                                'input': {
-                                    '$cond': {
-                                        'if': {
-                                            '$isArray': f'${field}'
-                                        },
-                                        'then': f'${field}',
-                                        'else': []
-                                    }
+def _build_array_complex_wrapper(field: str, condition: dict) -> dict:
+    """
+    Wraps a condition on an array of complex objects, so it matches if any of the elements matches
+    :param field: the array field name, its elements are referred to by its last part
+    :param condition: the condition, already built against the elements
+    :return: the wrapping aggregation expression
+    """
+    field_ref = f'${field}'
+    return {
+        _AND: [
+            {
+                _IS_ARRAY: field_ref
+            },
+            {
+                _ANY_ELEMENT_TRUE: {
+                    _MAP: {
+                        _INPUT: {
+                            _COND: {
+                                _IF: {
+                                    _IS_ARRAY: field_ref
                                 },
-                                'as': field.split('.')[-1],
-                                'in': {
-                                    '$cond': {
-                                        'if': condition,
-                                        'then': True,
-                                        'else': False
-                                    }
-                                }
+                                _THEN: field_ref,
+                                _ELSE: []
+                            }
+                        },
+                        _AS: field.rpartition('.')[2],
+                        _IN: {
+                            _COND: {
+                                _IF: condition,
+                                _THEN: True,
+                                _ELSE: False
                             }
                         }
                     }
-                ]
+                }
             }
+        ]
+    }
+
 
+class ProjectionMap(object):
+    def resolve_field(self, node):
+        # the same field paths repeat across a query and end up as keys and set lookups - share one string per path
+        return sys.intern(_FIELD_NAME.handle(node))
+
+    def handle(self, operator, left, right, ctx=_EMPTY_CTX):
+        field = self.resolve_field(left)
+        array_fields, complex_fields = ctx.array_fields, ctx.complex_fields
+        is_wrapped = bool(array_fields) and bool(complex_fields) and field in array_fields and field in complex_fields
+        condition = self.resolve_type(field).handle_operator_with_right_and_left(operator, right,
+                                                                                 ctx.compare(field))
+        if is_wrapped:
+            return _build_array_complex_wrapper(field, condition)
         return condition
 
 
@@ -158,7 +257,7 @@ class ProjectionSchemaFreeOperatorMap(ProjectionMap):
         return None
 
     def resolve_type(self, field):
-        return ProjectionGenericField()
+        return _GENERIC_FIELD
 
 
 class SchemaAwareOperatorMap(OperatorMap):
@@ -185,69 +284,98 @@ class SchemaAwareOperatorMap(OperatorMap):
 class ProjectionFunc(BaseFunc, ProjectionAstHandler):
 
     @staticmethod
-    def parse_arg(node, index, field, **kwargs):
-        return field.handle(ProjectionFunc.get_arg(node, index), **kwargs)
+    def parse_arg(node, index, field, ctx=None):
+        arg = ProjectionFunc.get_arg(node, index)
+        if ctx is None:
+            return field.handle(arg)
+        return field.handle(arg, ctx)
 
-    def handle(self, node, **kwargs):
+    def handle(self, node, ctx=None):
         try:
-            handler = getattr(self, 'handle_' + node.func.id)
-        except AttributeError:
+            handler = self._DISPATCH[node.func.id]
+        except KeyError:
             raise ParseError('Unsupported function ({0}).'.format(node.func.id),
                              col_offset=node.col_offset,
                              options=self.get_options())
-        return handler(node, **kwargs)
+        if ctx is None:
+            return handler(self, node)
+        return handler(self, node, ctx)
 
-    def handle_exists(self, node):
+    @staticmethod
+    def get_value_ref(node, ctx):
+        if ctx.value_ref is None:
+            raise ParseError('{0} must be compared with a field.'.format(node.func.id), col_offset=node.col_offset)
+        return ctx.value_ref
+
+    def handle_exists(self, node, ctx=_EMPTY_CTX):
+        # $exists is a query operator only, in an aggregation expression a missing field has the 'missing' type
+        field = self.get_value_ref(node, ctx)
+        arg = self.get_arg(node, 0)
+        exists = _BOOL_FIELD.SPECIAL_VALUES.get(getattr(arg, 'id', None))
+        if not isinstance(exists, bool):
+            raise ParseError('Invalid argument for exists, expected a boolean.', col_offset=arg.col_offset,
+                             options=['true', 'false'])
         return {
-            '$exists': self.parse_arg(node, 0, ProjectionBoolField())
+            _NE if exists else _EQ: [
+                {
+                    _TYPE: field
+                },
+                _MISSING
+            ]
         }
 
 
 class ProjectionStringFunc(ProjectionFunc):
 
-    def handle_regexMatch(self, node, compared_field=None, array_fields=None, complex_fields=None):
-        if array_fields and compared_field in array_fields:
-            field = f'$${compared_field.split(".")[-1]}'
-        else:
-            field = f'${compared_field}'
-        result = {
-            '$and': [
+    @staticmethod
+    def get_string_arg(node, index, name):
+        # checked here - an 'Unsupported syntax' error would be taken for a field comparison by the parser
+        arg = ProjectionFunc.get_arg(node, index)
+        if not isinstance(getattr(arg, 's', None), str):
+            raise ParseError('Invalid {0} {1}, expected a string.'.format(node.func.id, name),
+                             col_offset=arg.col_offset)
+        return arg.s
+
+    def handle_regexMatch(self, node, ctx=_EMPTY_CTX):
+        field = self.get_value_ref(node, ctx)
+        regex_match = {
+            _INPUT: field,
+            _REGEX: self.get_string_arg(node, 0, 'regex'),
+        }
+        if len(node.args) > 1:
+            regex_match[_OPTIONS] = self.get_string_arg(node, 1, 'options')
+        return {
+            _AND: [
                 {
-                    '$eq': [
-                        'string',
+                    _EQ: [
+                        _STRING,
                         {
-                            '$type': field
+                            _TYPE: field
                         }
                     ]
                 },
                 {
-                    '$regexMatch': {
-                        'input': field,
-                        'regex': self.parse_arg(node, 0, ProjectionStringField()),
-                    }
+                    _REGEX_MATCH: regex_match
                 }
             ]
         }
-        try:
-            result['$and'][1]['$regexMatch']['options'] = self.parse_arg(node, 1, ProjectionStringField())
-        except ParseError:
-            pass
-        return result
 
 
 class ProjectionGenericFunc(ProjectionStringFunc, IntFunc, ListFunc, DateTimeFunc):
     pass
 
 
+_GENERIC_FUNC = ProjectionGenericFunc()
+
+
 # ---Operators---#
 
 
 class ProjectionOperator(BaseOperator, ProjectionAstHandler):
 
-    def handle_Eq(self, node, compared_field=None, array_fields=None, complex_fields=None):
+    def handle_Eq(self, node, ctx=_EMPTY_CTX):
         '''=='''
-        return self.field.handle(node, compared_field=compared_field, array_fields=array_fields,
-                                 complex_fields=complex_fields)
+        return self.field.handle(node, ctx)
 
 
 class ProjectionAlgebricOperator(ProjectionOperator):
@@ -260,16 +388,24 @@ class ProjectionAlgebricOperator(ProjectionOperator):
 class ProjectionField(BaseField, ProjectionAstHandler):
     OP_CLASS = ProjectionOperator
 
-    def handle_Name(self, node, compared_field=None, **kwargs):
+    def handle_Name(self, node, ctx=_EMPTY_CTX):
         try:
-            return {
-                '$eq': [f'${compared_field}', self.SPECIAL_VALUES[node.id]]
-            }
+            value = self.SPECIAL_VALUES[node.id]
         except KeyError:
             raise ParseError('Invalid name: {0}'.format(node.id), node.col_offset, options=list(self.SPECIAL_VALUES))
+        if ctx.value_ref is None:
+            return value
+        return {
+            _EQ: [ctx.value_ref, value]
+        }
 
-    def handle_operator_with_right_and_left(self, operator, right, **kwargs):
-        return self.OP_CLASS(self).resolve(operator)(right, **kwargs)
+    def handle_operator_with_right_and_left(self, operator, right, ctx=_EMPTY_CTX):
+        # the operator only holds this field, so one instance per field is enough
+        try:
+            op = self._operator
+        except AttributeError:
+            op = self._operator = self.OP_CLASS(self)
+        return op._handler_for(operator)(op, right, ctx)
 
 
 class ProjectionAlgebricField(ProjectionField):
@@ -278,43 +414,49 @@ class ProjectionAlgebricField(ProjectionField):
 
 class ProjectionStringField(StringBaseField, ProjectionAlgebricField):
 
-    def handle_Str(self, node, compared_field=None, array_fields=None, complex_fields=None):
-        if not compared_field:
+    def handle_Str(self, node, ctx=_EMPTY_CTX):
+        if ctx.value_ref is None:
             return node.s
-        if array_fields and compared_field in array_fields:
-            field = f'$${compared_field.split(".")[-1]}'
-        else:
-            field = f'${compared_field}'
-        return {'$eq': [field, node.s]}
+        return {_EQ: [ctx.value_ref, node.s]}
+
+
+_STR_FIELD = ProjectionStringField()
 
 
 class ProjectionIntField(IntBaseField, ProjectionAlgebricField):
-    def handle_Num(self, node, compared_field=None, array_fields=None, complex_fields=None):
-        if array_fields and compared_field in array_fields:
-            field = f'$${compared_field.split(".")[-1]}'
-        else:
-            field = f'${compared_field}'
-        return {'$eq': [field, node.n]}
+    def handle_Num(self, node, ctx=_EMPTY_CTX):
+        if ctx.value_ref is None:
+            return node.n
+        return {_EQ: [ctx.value_ref, node.n]}
 
 
 class ProjectionBoolField(BoolBaseField, ProjectionField):
     pass
 
 
+_BOOL_FIELD = ProjectionBoolField()
+
+
 class ProjectionListField(ListBaseField, ProjectionField):
     pass
 
 
 class ProjectionDictField(DictBaseField, ProjectionField):
 
-    def handle_Dict(self, node, **kwargs):
+    def handle_Dict(self, node, ctx=_EMPTY_CTX):
+        # this is an aggregation expression, where a multi key document is an object literal and not a conjunction,
+        # so each pair is kept in its own document
+        value_field = self._field or _GENERIC_FIELD
         return {
-            '$and': [{ProjectionStringField().handle(key): (self._field or ProjectionGenericField()).handle(value)}
-                     for key, value in zip(node.keys, node.values)]
+            _AND: [{_STR_FIELD.handle(key): value_field.handle(value)}
+                   for key, value in zip(node.keys, node.values)]
         }
 
 
 class ProjectionGenericField(ProjectionIntField, ProjectionBoolField, ProjectionStringField,
                              ProjectionListField, ProjectionDictField):
-    def handle_Call(self, node, **kwargs):
-        return ProjectionGenericFunc().handle(node, **kwargs)
+    def handle_Call(self, node, ctx=None):
+        return _GENERIC_FUNC.handle(node, ctx)
+
+
+_GENERIC_FIELD = ProjectionGenericField()
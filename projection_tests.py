@@ -0,0 +1,137 @@
+from unittest import TestCase
+from axonius.consts.system_consts import MULTI_COMPARE_MAGIC_STRING, COMPARE_MAGIC_STRING
+from axonius.pql.matching import ParseError, IntField
+from axonius.pql.projection.matching import (ProjectionParser, ProjectionSchemaFreeParser,
+                                             SchemaFreeOperatorMap, SchemaAwareOperatorMap)
+
+
+class BaseProjectionTestCase(TestCase):
+
+    def parse(self, string, **kwargs):
+        return ProjectionSchemaFreeParser().parse(string, **kwargs)
+
+    def compare(self, string, expected, **kwargs):
+        print("{} | {}".format(string, expected))
+        self.assertEqual(self.parse(string, **kwargs), expected)
+
+
+class ProjectionSchemaFreeTestCase(BaseProjectionTestCase):
+
+    def test_equal_string(self):
+        self.compare('a == "foo"', {'$eq': ['$a', 'foo']})
+
+    def test_equal_int(self):
+        self.compare('a.b == 1', {'$eq': ['$a.b', 1]})
+
+    def test_and(self):
+        self.compare('a == 1 and b == "foo"', {'$and': [{'$eq': ['$a', 1]}, {'$eq': ['$b', 'foo']}]})
+
+    def test_not(self):
+        self.compare('not a == 1', {'$not': {'$eq': ['$a', 1]}})
+
+    def test_array_field(self):
+        self.compare('a.b == 1', {'$eq': ['$$b', 1]}, array_fields=['a.b'])
+
+    def test_array_complex_field(self):
+        self.compare('a.b == "foo"',
+                     {'$and': [
+                         {'$isArray': '$a.b'},
+                         {'$anyElementTrue': {
+                             '$map': {
+                                 'input': {'$cond': {'if': {'$isArray': '$a.b'}, 'then': '$a.b', 'else': []}},
+                                 'as': 'b',
+                                 'in': {'$cond': {'if': {'$eq': ['$$b', 'foo']}, 'then': True, 'else': False}}
+                             }
+                         }}
+                     ]},
+                     array_fields=['a.b'], complex_fields=['a.b'])
+
+    def test_special_name(self):
+        self.compare('a == true', {'$eq': ['$a', True]})
+        self.compare('a == null', {'$eq': ['$a', None]})
+        self.compare('a.b == true', {'$eq': ['$$b', True]}, array_fields=['a.b'])
+        self.compare('a == {"k": true}', {'$and': [{'k': True}]})
+
+    def test_dict(self):
+        self.compare('a == {"k": "s"}', {'$and': [{'k': 's'}]})
+        self.compare('a == {"k": "s", "j": "t"}', {'$and': [{'k': 's'}, {'j': 't'}]})
+        self.compare('a == {"k": "s", "k": "t"}', {'$and': [{'k': 's'}, {'k': 't'}]})
+
+    def test_dict_number(self):
+        self.compare('a == {"k": 1}', {'$and': [{'k': 1}]})
+        self.compare('a == {"k": 1, "j": "s"}', {'$and': [{'k': 1}, {'j': 's'}]})
+
+    def test_array_field_string(self):
+        self.compare('a.b == "foo"', {'$eq': ['$$b', 'foo']}, array_fields=['a.b'])
+
+    def test_bare_dict(self):
+        self.compare('{}', {})
+        self.compare('{"k": 1}', {})
+        self.compare('not {}', {'$not': {}})
+
+    def test_result_is_not_shared(self):
+        self.parse('a == 1 and b == 2')['$and'].append('X')
+        self.compare('a == 1 and b == 2', {'$and': [{'$eq': ['$a', 1]}, {'$eq': ['$b', 2]}]})
+
+    def test_exists(self):
+        self.compare('a == exists(true)', {'$ne': [{'$type': '$a'}, 'missing']})
+        self.compare('a.b == exists(false)', {'$eq': [{'$type': '$$b'}, 'missing']}, array_fields=['a.b'])
+
+    def test_exists_invalid_argument(self):
+        with self.assertRaises(ParseError) as context:
+            self.parse('a == exists(null)')
+        self.assertIn('Invalid argument for exists', str(context.exception))
+
+    def test_exists_without_field(self):
+        with self.assertRaises(ParseError) as context:
+            self.parse('a == {"k": exists(true)}')
+        self.assertIn('exists must be compared with a field', str(context.exception))
+
+    def test_regex_match(self):
+        self.compare('a == regexMatch("foo")',
+                     {'$and': [{'$eq': ['string', {'$type': '$a'}]},
+                               {'$regexMatch': {'input': '$a', 'regex': 'foo'}}]})
+        self.compare('a == regexMatch("foo", "i")',
+                     {'$and': [{'$eq': ['string', {'$type': '$a'}]},
+                               {'$regexMatch': {'input': '$a', 'regex': 'foo', 'options': 'i'}}]})
+
+    def test_regex_match_without_field(self):
+        with self.assertRaises(ParseError) as context:
+            self.parse('a == {"k": regexMatch("foo")}')
+        self.assertIn('regexMatch must be compared with a field', str(context.exception))
+
+    def test_regex_match_invalid_options(self):
+        with self.assertRaises(ParseError) as context:
+            self.parse('a == regexMatch("foo", 1)')
+        self.assertIn('Invalid regexMatch options', str(context.exception))
+        with self.assertRaises(ParseError) as context:
+            self.parse('a == regexMatch(1)')
+        self.assertIn('Invalid regexMatch regex', str(context.exception))
+
+    def test_field_comparison(self):
+        self.compare('a == b.c', {COMPARE_MAGIC_STRING: {'Eq': ['a', 'b.c']}})
+        self.compare('a != b.c', {COMPARE_MAGIC_STRING: {'NotEq': ['a', 'b.c']}})
+        self.compare('a.b < c.d + 1', {MULTI_COMPARE_MAGIC_STRING: {'Lt': 1, 'Add': ['a.b', 'c.d']}})
+
+
+class ProjectionOperatorMapTestCase(TestCase):
+
+    def test_schema_free_map(self):
+        self.assertEqual(ProjectionParser(SchemaFreeOperatorMap()).parse('a == 1'), {'a': 1})
+
+    def test_schema_aware_map(self):
+        parser = ProjectionParser(SchemaAwareOperatorMap({'a': IntField()}))
+        self.assertEqual(parser.parse('a == 1'), {'a': 1})
+
+    def test_schema_aware_map_invalid_field(self):
+        parser = ProjectionParser(SchemaAwareOperatorMap({'a': IntField()}))
+        with self.assertRaises(ParseError) as context:
+            parser.parse('b == 1')
+        self.assertIn('Field not found', str(context.exception))
+
+    def test_schema_aware_map_field_comparison(self):
+        parser = ProjectionParser(SchemaAwareOperatorMap({'a': IntField()}))
+        self.assertEqual(parser.parse('a == b.c'), {COMPARE_MAGIC_STRING: {'Eq': ['a', 'b.c']}})
+        with self.assertRaises(ParseError) as context:
+            parser.parse('zz == b.c')
+        self.assertIn('Field not found', str(context.exception))